@@ -8,6 +8,10 @@ file based on the lastest configuration file read.
 import re
 import os
 import sys
+import gc
+import time
+import resource
+import multiprocessing
 import textwrap
 import argparse
 import glob
@@ -16,6 +20,7 @@ from datetime import datetime
 from lexor import core
 from lexor import lexor
 from lexor.command.to import language_style
+from esmero import minify, sitemap
 from esmero.command import config, error, warn
 
 
@@ -29,13 +34,31 @@ is given. i.e.
 
 Note that the extension is not necessary.
 
+Large websites may be built in stream mode by giving a page or
+memory budget with the `--max-pages` and `--max-memory` options (or
+the `build.max_pages` and `build.max_memory` configuration keys).
+The pages are then built in worker processes which are replaced after
+building `max_pages` pages or once their memory grows by `max_memory`
+megabytes. The memory taken by the theme and the largest growth of
+each worker are reported.
+
 """
 
 
+STYLE_CACHE = dict()
+CONVERTER_CACHE = dict()
+STYLE_STATS = {
+    'lookups': 0,
+    'misses': 0,
+    'time': 0.0,
+}
+
 DEFAULTS = {
     'website_path': '.',
     'assets_path': '.',
     'lexor_inputs': '',
+    'max_pages': '0',
+    'max_memory': '0',
 }
 
 
@@ -56,6 +79,12 @@ def add_parser(subp, fclass):
                       help="supress output")
     tmpp.add_argument('--force', '-f', action='store_true',
                       help="force page creation")
+    tmpp.add_argument('--max-pages', type=str, metavar='N',
+                      help="stream mode: recycle the build process "
+                           "after N pages")
+    tmpp.add_argument('--max-memory', type=str, metavar='MB',
+                      help="stream mode: recycle the build process "
+                           "once its memory grows by MB megabytes")
 
 
 def gather_lexor_files(path, bfiles):
@@ -105,15 +134,15 @@ def gather_lexor_files(path, bfiles):
 def _append_queue(path, queue, files):
     """Recursive definition to gather the files in a path. """
     cfg, files, other = gather_lexor_files(path, files)
-    queue.append((cfg, files))
+    queue.append((path, cfg, files))
     for path in other:
         _append_queue(path, queue, files)
 
 
 def build_lexor_list(path, files):
     """Use this function instead of `gather_lexor_files` to get a
-    list of lexor files to transform along with the configuration
-    files."""
+    list of lexor files to transform along with the website paths
+    and configuration files."""
     queue = list()
     _append_queue(path, queue, files)
     return queue
@@ -162,6 +191,69 @@ def get_theme_templates(root):
     return theme, redo
 
 
+def lexor_inputs(settings, base):
+    """Return the lexor search path of a website: its `lexor-path`
+    followed by the `base` search path without repeated entries. """
+    paths = list()
+    for path in [settings.get('lexor-path', '')] + base.split(':'):
+        if path and path not in paths:
+            paths.append(path)
+    return ':'.join(paths)
+
+
+def get_style(name, *args):
+    """Return the lexor `Parser` or `Writer` for the given language
+    and style. The object is created only once for each value of
+    LEXORINPUTS and kept in `STYLE_CACHE`. See `get_converter` for
+    converters. """
+    key = (os.environ.get('LEXORINPUTS', ''), name) + args
+    STYLE_STATS['lookups'] += 1
+    if key not in STYLE_CACHE:
+        STYLE_STATS['misses'] += 1
+        start = time.time()
+        STYLE_CACHE[key] = getattr(core, name)(*args)
+        STYLE_STATS['time'] += time.time() - start
+    return STYLE_CACHE[key]
+
+
+# pylint: disable=W0212
+def get_converter(fromlang, tolang, style):
+    """Return a new lexor `Converter`. The style module, its defaults
+    and its node converter classes are resolved by the first converter
+    created for each value of LEXORINPUTS and kept in
+    `CONVERTER_CACHE`. The following converters receive them instead
+    of searching for the style again.
+
+    A converter keeps the node converter instances, packages and log
+    of the document it converts, so it is not shared between pages.
+    Only the resolved classes are. The cached style module is not
+    reloaded for each page, so its module level state persists. """
+    converter = core.Converter(fromlang, tolang, style)
+    key = (os.environ.get('LEXORINPUTS', ''), fromlang, tolang, style)
+    STYLE_STATS['lookups'] += 1
+    if key not in CONVERTER_CACHE:
+        STYLE_STATS['misses'] += 1
+        start = time.time()
+        converter._set_node_converters(fromlang, tolang, style,
+                                       converter.defaults)
+        CONVERTER_CACHE[key] = (
+            converter.style_module,
+            dict(converter.defaults),
+            [item.nc_class for item in converter._node_converters.values()]
+        )
+        STYLE_STATS['time'] += time.time() - start
+        return converter
+    module, defaults, repo = CONVERTER_CACHE[key]
+    converter.style_module = module
+    converter.defaults = dict(defaults)
+    converter._directives = dict()
+    converter._node_converters = dict()
+    for nc_class in repo:
+        converter.register(nc_class)
+    converter._reload = False
+    return converter
+
+
 def build_file(lex_file, theme, parser, settings, docwriter, logwriter, arg, cfg):
     with open(lex_file, 'r') as tmpf:
         text = tmpf.read()
@@ -179,7 +271,11 @@ def build_file(lex_file, theme, parser, settings, docwriter, logwriter, arg, cfg
     doc.meta['usepackage'] = ver + pkg
     doc.meta['__THEME__'] = theme[ver].clone_node(True)
     doc.meta['__ROOT__'] = cfg['esmero']['root']
-    converter = core.Converter('lexor', 'html', 'default')
+    meta = dict(
+        (key, val) for key, val in doc.meta.iteritems()
+        if not key.startswith('__')
+    )
+    converter = get_converter('lexor', 'html', 'default')
     converter.convert(doc)
     if parser.log:
         converter.update_log(parser.log, False)
@@ -191,48 +287,223 @@ def build_file(lex_file, theme, parser, settings, docwriter, logwriter, arg, cfg
     docwriter.write(doc, lex_file[:-4] + '.html', 'w')
     namespace = core.get_converter_namespace()
     namespace.clear()
-
-
-def build_site(arg, cfg, settings, files):
-    """Build the website. """
-    theme, theme_redo = get_theme_templates(settings['theme-path'])
-    parser = core.Parser('lexor', 'default')
-    docwriter = core.Writer('html', 'default')
-    logwriter = core.Writer('lexor', 'log')
+    return meta
+
+
+def peak_memory():
+    """Return the resident memory high-water mark of the current
+    process in megabytes. """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / (1024.0 * 1024.0)
+    return peak / 1024.0
+
+
+def current_memory():
+    """Return the resident memory of the current process in
+    megabytes. Falls back to `peak_memory` on systems without
+    `/proc`. """
+    try:
+        with open('/proc/self/statm') as tmpf:
+            pages = int(tmpf.read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return peak_memory()
+    return pages * resource.getpagesize() / (1024.0 * 1024.0)
+
+
+def get_budget(cfg):
+    """Return the page and memory budget of the stream mode. """
+    try:
+        max_pages = int(cfg['build']['max_pages'])
+        max_memory = float(cfg['build']['max_memory'])
+    except ValueError:
+        error("ERROR: max_pages and max_memory must be numbers.\n")
+    if max_pages < 0 or max_memory < 0:
+        error("ERROR: max_pages and max_memory must not be negative.\n")
+    return max_pages, max_memory
+
+
+def check_file(fname, arg, theme_redo):
+    """Return the reason for which the html file of `fname` needs to
+    be built or `None` if it is up to date. """
+    if theme_redo:
+        return 'THEME CHANGE'
+    if arg.force:
+        return 'FORCE'
+    html_file = fname[:-4] + '.html'
+    if not pth.exists(html_file):
+        return 'FILE CHANGE'
+    date_lex = datetime.fromtimestamp(pth.getmtime(fname))
+    date_html = datetime.fromtimestamp(pth.getmtime(html_file))
+    if date_html < date_lex:
+        return 'FILE CHANGE'
+    return None
+
+
+def get_cache_path(settings, path):
+    """Return the directory where esmero keeps the cached data of a
+    website. """
+    return settings.get('cache-path', pth.join(path, '.esmero'))
+
+
+def minify_page(fname, settings, path):
+    """Minify the html file of `fname` if the website requests it. """
+    options = minify.get_options(settings)
+    if options:
+        minify.minify_file(fname[:-4] + '.html', options,
+                           pth.join(get_cache_path(settings, path), 'minify'))
+
+
+def _build_worker(conn, files, theme, theme_redo, arg, cfg, settings, path,
+                  budget):
+    """Build files until the page budget is reached or the resident
+    memory of the worker grows by more than the memory budget. Sends
+    the number of files checked, built, the largest memory growth of
+    the worker, the metadata of the built pages and the style lookup
+    counts through `conn` before exiting."""
+    for key in STYLE_STATS:
+        STYLE_STATS[key] = 0
+    max_pages, max_memory = budget
+    start = current_memory()
+    growth = 0.0
+    parser = get_style('Parser', 'lexor', 'default')
+    docwriter = get_style('Writer', 'html', 'default')
+    logwriter = get_style('Writer', 'lexor', 'log')
+    checked = 0
+    built = 0
+    pages = dict()
     for fname in files:
+        checked += 1
         sys.stderr.write('Checking %s ... ' % fname)
-        if theme_redo:
-            sys.stderr.write(' [THEME CHANGE]: Building ... ')
-            build_file(fname, theme, parser, settings, docwriter, logwriter, arg, cfg)
+        reason = check_file(fname, arg, theme_redo)
+        if reason is None:
             sys.stderr.write('done.\n')
             continue
-        if arg.force:
-            sys.stderr.write(' [FORCE]: Building ... ')
-            build_file(fname, theme, parser, settings, docwriter, logwriter, arg, cfg)
+        sys.stderr.write(' [%s]: Building ... ' % reason)
+        pages[fname] = build_file(fname, theme, parser, settings,
+                                  docwriter, logwriter, arg, cfg)
+        minify_page(fname, settings, path)
+        sys.stderr.write('done.\n')
+        built += 1
+        parser.doc = None
+        gc.collect()
+        growth = max(growth, current_memory() - start)
+        if max_pages and built >= max_pages:
+            break
+        if max_memory and growth >= max_memory:
+            break
+    conn.send((checked, built, growth, pages, STYLE_STATS))
+    conn.close()
+
+
+def build_site_stream(arg, cfg, settings, files, path, theme, theme_redo,
+                      budget):
+    """Build the website using short lived worker processes. Each
+    worker releases the state of a page after writing it and is
+    replaced once it reaches the limits given by the `max_pages` and
+    `max_memory` settings. Returns the metadata of the built pages.
+    """
+    pages = dict()
+    index = 0
+    worker = 0
+    total = 0
+    while index < len(files):
+        worker += 1
+        recv, send = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(
+            target=_build_worker,
+            args=(send, files[index:], theme, theme_redo,
+                  arg, cfg, settings, path, budget)
+        )
+        proc.start()
+        send.close()
+        try:
+            checked, built, growth, worker_pages, stats = recv.recv()
+        except EOFError:
+            proc.join()
+            error("ERROR: build worker exited with code %s\n" % proc.exitcode)
+        proc.join()
+        index += checked
+        total += built
+        pages.update(worker_pages)
+        for key in STYLE_STATS:
+            STYLE_STATS[key] += stats[key]
+        sys.stderr.write(
+            '[MEMORY]: worker %d: %d pages, +%.1f MB\n' % (
+                worker, built, growth
+            )
+        )
+    sys.stderr.write(
+        '[MEMORY]: site: %d pages, %d workers, %.1f MB resident\n' % (
+            total, worker, current_memory()
+        )
+    )
+    return pages
+
+
+def build_site(arg, cfg, settings, files, path='.'):
+    """Build the website. """
+    start = current_memory()
+    theme, theme_redo = get_theme_templates(settings['theme-path'])
+    cache_path = get_cache_path(settings, path)
+    index = None
+    unindexed = set()
+    if sitemap.enabled(settings):
+        index = sitemap.load_index(cache_path)
+        unindexed = sitemap.unindexed(index, path, files)
+    budget = get_budget(cfg)
+    if budget[0] or budget[1]:
+        sys.stderr.write(
+            '[MEMORY]: theme: +%.1f MB\n' % (current_memory() - start)
+        )
+        # Resolve the styles before forking so every worker inherits them
+        get_style('Parser', 'lexor', 'default')
+        get_style('Writer', 'html', 'default')
+        get_style('Writer', 'lexor', 'log')
+        get_converter('lexor', 'html', 'default')
+        pages = build_site_stream(arg, cfg, settings, files, path, theme,
+                                  theme_redo, budget)
+    else:
+        pages = dict()
+        parser = get_style('Parser', 'lexor', 'default')
+        docwriter = get_style('Writer', 'html', 'default')
+        logwriter = get_style('Writer', 'lexor', 'log')
+        for fname in files:
+            sys.stderr.write('Checking %s ... ' % fname)
+            reason = check_file(fname, arg, theme_redo)
+            if reason is not None:
+                sys.stderr.write(' [%s]: Building ... ' % reason)
+                pages[fname] = build_file(fname, theme, parser, settings,
+                                          docwriter, logwriter, arg, cfg)
+                minify_page(fname, settings, path)
+                parser.doc = None
             sys.stderr.write('done.\n')
-            continue
-        redo = False
-        html_file = fname[:-4] + '.html'
-        if pth.exists(html_file):
-            date_lex = datetime.fromtimestamp(pth.getmtime(fname))
-            date_html = datetime.fromtimestamp(pth.getmtime(html_file))
-            if date_html < date_lex:
-                redo = True
-        else:
-            redo = True
-        if redo:
-            sys.stderr.write(' [FILE CHANGE]: Building ... ')
-            build_file(fname, theme, parser, settings, docwriter, logwriter, arg, cfg)
+    if index is not None:
+        for fname in unindexed:
+            if fname not in pages:
+                pages[fname] = None
+        sys.stderr.write('Writing sitemap ... ')
+        sitemap.publish(path, settings, cache_path, index, pages,
+                        None if arg.files else files)
         sys.stderr.write('done.\n')
 
 
 def run():
     """Run the command. """
-    lexorinputs = os.environ['LEXORINPUTS']
+    lexorinputs = os.environ.get('LEXORINPUTS', '')
     arg = config.CONFIG['arg']
     cfg = config.get_cfg(['build'])
     queue = build_lexor_list(arg.inputpath, arg.files)
-    for settings, files in queue:
-        os.environ['LEXORINPUTS'] = '%s:%s' % (settings['lexor-path'], lexorinputs)
-        print os.environ['LEXORINPUTS']
-        build_site(arg, cfg, settings, files)
+    try:
+        for path, settings, files in queue:
+            os.environ['LEXORINPUTS'] = lexor_inputs(settings, lexorinputs)
+            sys.stderr.write('[LEXORINPUTS]: %s\n' % os.environ['LEXORINPUTS'])
+            build_site(arg, cfg, settings, files, path)
+    finally:
+        os.environ['LEXORINPUTS'] = lexorinputs
+    sys.stderr.write(
+        '[STYLES]: %d lookups, %d resolved in %.3fs\n' % (
+            STYLE_STATS['lookups'], STYLE_STATS['misses'],
+            STYLE_STATS['time']
+        )
+    )
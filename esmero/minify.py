@@ -0,0 +1,109 @@
+"""Minify
+
+Compacts the html files written by the build command. The stage is
+enabled for a website by the `minify` key in its `esmero.config`
+file. Use `true` to apply every transformation or an object to
+select them, i.e.
+
+    "minify": {
+        "whitespace": true,
+        "comments": true,
+        "optional-tags": false
+    }
+
+Only the files built in the current run are minified. The `minify`
+directory of the website cache keeps one entry per output file with
+the md5 hash of the html it was computed from, so a page which is
+rebuilt without changes is not minified again and the cache does not
+grow past the number of pages.
+
+Whitespace is only collapsed in the text between tags; attribute
+values are left untouched.
+
+"""
+
+import os
+import re
+import hashlib
+import os.path as pth
+
+
+OPTIONS = ['whitespace', 'comments', 'optional-tags']
+
+RE_PRESERVE = re.compile(
+    r'(<(pre|textarea|script|style)\b.*?</\2\s*>)',
+    re.IGNORECASE | re.DOTALL
+)
+RE_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL)
+RE_SPACE = re.compile(r'\s+')
+RE_TAG = re.compile(r'(<(?:[^>"\']|"[^"]*"|\'[^\']*\')*>)')
+RE_OPTIONAL = re.compile(
+    r'</(li|dt|dd|option|thead|tbody|tfoot|tr|td|th|body|html)\s*>',
+    re.IGNORECASE
+)
+
+
+def get_options(settings):
+    """Return the list of transformations requested by the `minify`
+    key of the website settings. """
+    val = settings.get('minify', False)
+    if isinstance(val, dict):
+        return [opt for opt in OPTIONS if val.get(opt, False)]
+    if val in [True, 'true', 'True', '1']:
+        return list(OPTIONS)
+    return []
+
+
+def _collapse(text):
+    """Collapse the whitespace of the text between the tags. """
+    parts = RE_TAG.split(text)
+    for index in xrange(0, len(parts), 2):
+        parts[index] = RE_SPACE.sub(' ', parts[index])
+    return ''.join(parts)
+
+
+def minify(text, options):
+    """Return the minified version of the html string `text`. The
+    contents of `pre`, `textarea`, `script` and `style` elements are
+    left untouched. """
+    parts = RE_PRESERVE.split(text)
+    result = list()
+    index = 0
+    while index < len(parts):
+        part = parts[index]
+        if 'comments' in options:
+            part = RE_COMMENT.sub('', part)
+        if 'optional-tags' in options:
+            part = RE_OPTIONAL.sub('', part)
+        if 'whitespace' in options:
+            part = _collapse(part)
+        result.append(part)
+        if index + 1 < len(parts):
+            result.append(parts[index+1])
+        index += 3
+    return ''.join(result).strip()
+
+
+def minify_file(fname, options, cache_path):
+    """Minify the html file `fname` in place. """
+    with open(fname, 'r') as tmpf:
+        text = tmpf.read()
+    digest = hashlib.md5(','.join(options) + '\n' + text).hexdigest()
+    key = hashlib.md5(pth.normpath(fname)).hexdigest()
+    cache_file = pth.join(cache_path, key)
+    cached = None
+    if pth.exists(cache_file):
+        with open(cache_file, 'r') as tmpf:
+            if tmpf.readline().rstrip('\n') == digest:
+                cached = tmpf.read()
+    if cached is not None:
+        text = cached
+    else:
+        text = minify(text, options)
+        if not pth.exists(cache_path):
+            os.makedirs(cache_path)
+        with open(cache_file, 'w') as tmpf:
+            tmpf.write(digest + '\n')
+            tmpf.write(text)
+    with open(fname, 'w') as tmpf:
+        tmpf.write(text)
@@ -0,0 +1,271 @@
+"""Sitemap
+
+Generates the `sitemap.xml` and Atom feed of a website from an index
+of its pages kept in the website cache. The index is only updated
+for the pages built in the current run so that the output files do
+not need to be parsed again.
+
+The sitemap is enabled by the `site-url` key in the `esmero.config`
+file of the website. Sitemaps with more than `sitemap-size` entries
+(50000 by default) are split into `sitemap-N.xml` shards referenced
+by a sitemap index in `sitemap.xml`. The feed is written to
+`atom.xml` when `feed` is `true` or an object, i.e.
+
+    "feed": {
+        "title": "My website",
+        "author": "Me",
+        "entries": 20,
+        "match": "blog/.*"
+    }
+
+"""
+
+import os
+import re
+import json
+import urllib
+import hashlib
+import os.path as pth
+from datetime import datetime
+from xml.sax.saxutils import escape
+
+
+SITEMAP_SIZE = 50000
+FEED_ENTRIES = 20
+PAGE_META = ['title', 'date', 'author', 'description']
+DATE_FORMATS = [
+    '%Y-%m-%dT%H:%M:%SZ',
+    '%Y-%m-%dT%H:%M:%S',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%d %H:%M',
+    '%Y-%m-%d',
+    '%B %d, %Y',
+    '%b %d, %Y',
+    '%d %B %Y',
+]
+
+
+def enabled(settings):
+    """Return `True` if the website requests a sitemap. """
+    return 'site-url' in settings
+
+
+def _decode(val):
+    """Return byte strings decoded as utf-8. """
+    if isinstance(val, str):
+        return val.decode('utf-8')
+    return val
+
+
+def page_key(fname, path):
+    """Return the path of the html file of `fname` relative to the
+    website path. """
+    return _decode(pth.relpath(fname[:-4] + '.html', path))
+
+
+def load_index(cache_path):
+    """Read the page index stored in the website cache. """
+    try:
+        with open(pth.join(cache_path, 'pages.json')) as tmpf:
+            return json.load(tmpf)
+    except (IOError, ValueError):
+        return {'pages': {}, 'shards': {}}
+
+
+def save_index(cache_path, index):
+    """Write the page index to the website cache. """
+    if not pth.exists(cache_path):
+        os.makedirs(cache_path)
+    with open(pth.join(cache_path, 'pages.json'), 'w') as tmpf:
+        json.dump(index, tmpf, sort_keys=True)
+
+
+def unindexed(index, path, files):
+    """Return the set of lexor files which are not in the index. """
+    return set(
+        fname for fname in files
+        if page_key(fname, path) not in index['pages']
+    )
+
+
+def _timestamp(fname):
+    """Return the modification time of a file in W3C format. """
+    date = datetime.utcfromtimestamp(pth.getmtime(fname))
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parse_date(val):
+    """Return the page date `val` in W3C format or `None` if it
+    cannot be interpreted. """
+    for fmt in DATE_FORMATS:
+        try:
+            date = datetime.strptime(val.strip(), fmt)
+        except (ValueError, AttributeError):
+            continue
+        return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+    return None
+
+
+def update_index(index, path, pages, files=None):
+    """Update the index entries of the `pages`, a dictionary of lexor
+    files and their metadata. Pages with `None` as metadata are indexed
+    from their html file only, their metadata is added the next time
+    they are built. Pages whose html did not change keep their
+    `lastmod`. When `files` is given the entries of the pages which are
+    no longer part of the website are removed. """
+    for fname, meta in pages.iteritems():
+        html_file = fname[:-4] + '.html'
+        if not pth.exists(html_file):
+            continue
+        with open(html_file, 'r') as tmpf:
+            digest = hashlib.md5(tmpf.read()).hexdigest()
+        meta = meta or dict()
+        entry = dict(
+            (key, _decode(meta[key])) for key in PAGE_META if key in meta
+        )
+        key = page_key(fname, path)
+        old = index['pages'].get(key, dict())
+        if old.get('hash') == digest:
+            entry['lastmod'] = old['lastmod']
+        else:
+            entry['lastmod'] = _timestamp(html_file)
+        entry['hash'] = digest
+        index['pages'][key] = entry
+    if files is not None:
+        keys = set(page_key(fname, path) for fname in files)
+        for key in index['pages'].keys():
+            if key not in keys:
+                del index['pages'][key]
+
+
+def _write_xml(path, name, text, index):
+    """Write an xml file unless its content has not changed. """
+    digest = hashlib.md5(text.encode('utf-8')).hexdigest()
+    fname = pth.join(path, name)
+    if index['shards'].get(name) == digest and pth.exists(fname):
+        return
+    with open(fname, 'w') as tmpf:
+        tmpf.write(text.encode('utf-8'))
+    index['shards'][name] = digest
+
+
+def _url(settings, key):
+    """Return the absolute url of a page. """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return '%s/%s' % (settings['site-url'].rstrip('/'), urllib.quote(key))
+
+
+def _urlset(settings, keys, pages):
+    """Return the content of a sitemap listing `keys`. """
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+    ]
+    for key in keys:
+        lines.append(
+            '<url><loc>%s</loc><lastmod>%s</lastmod></url>' % (
+                escape(_url(settings, key)), pages[key]['lastmod']
+            )
+        )
+    lines.append('</urlset>\n')
+    return u'\n'.join(lines)
+
+
+def _remove_shards(path, index, names):
+    """Remove the sitemap shards which are not in `names`. """
+    for name in index['shards'].keys():
+        if name.startswith('sitemap-') and name not in names:
+            if pth.exists(pth.join(path, name)):
+                os.remove(pth.join(path, name))
+            del index['shards'][name]
+
+
+def write_sitemap(path, settings, index):
+    """Write the sitemap of the website, split into shards when the
+    number of pages exceeds the `sitemap-size` setting. """
+    pages = index['pages']
+    keys = sorted(pages.keys())
+    size = int(settings.get('sitemap-size', SITEMAP_SIZE))
+    if len(keys) <= size:
+        _write_xml(path, 'sitemap.xml', _urlset(settings, keys, pages),
+                   index)
+        _remove_shards(path, index, set())
+        return
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<sitemapindex '
+        'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">',
+    ]
+    names = set()
+    for num, start in enumerate(xrange(0, len(keys), size)):
+        shard = keys[start:start+size]
+        name = 'sitemap-%d.xml' % (num + 1)
+        names.add(name)
+        _write_xml(path, name, _urlset(settings, shard, pages), index)
+        lines.append(
+            '<sitemap><loc>%s</loc><lastmod>%s</lastmod></sitemap>' % (
+                escape(_url(settings, name)),
+                max(pages[key]['lastmod'] for key in shard)
+            )
+        )
+    lines.append('</sitemapindex>\n')
+    _write_xml(path, 'sitemap.xml', u'\n'.join(lines), index)
+    _remove_shards(path, index, names)
+
+
+def write_feed(path, settings, index):
+    """Write the Atom feed with the most recent pages of the
+    website. """
+    feed = settings['feed']
+    if not isinstance(feed, dict):
+        feed = dict()
+    pages = index['pages']
+    rmatch = re.compile(feed.get('match', '.*'))
+    keys = [key for key in pages if rmatch.match(key)]
+    dates = dict(
+        (key, _parse_date(pages[key].get('date')) or pages[key]['lastmod'])
+        for key in keys
+    )
+    keys.sort(key=lambda x: dates[x], reverse=True)
+    keys = keys[:int(feed.get('entries', FEED_ENTRIES))]
+    updated = max([dates[key] for key in keys] or
+                  [datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')])
+    site_url = settings['site-url'].rstrip('/') + '/'
+    lines = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<feed xmlns="http://www.w3.org/2005/Atom">',
+        '<id>%s</id>' % escape(site_url),
+        '<title>%s</title>' % escape(feed.get('title', site_url)),
+        '<updated>%s</updated>' % updated,
+        '<link rel="self" href="%s"/>' % escape(site_url + 'atom.xml'),
+        '<author><name>%s</name></author>' % escape(
+            feed.get('author', settings.get('author', site_url))
+        ),
+    ]
+    for key in keys:
+        page = pages[key]
+        url = escape(_url(settings, key))
+        lines.append('<entry>')
+        lines.append('<id>%s</id>' % url)
+        lines.append('<title>%s</title>' % escape(page.get('title', key)))
+        lines.append('<link href="%s"/>' % url)
+        lines.append('<updated>%s</updated>' % dates[key])
+        if 'description' in page:
+            lines.append(
+                '<summary>%s</summary>' % escape(page['description'])
+            )
+        lines.append('</entry>')
+    lines.append('</feed>\n')
+    _write_xml(path, 'atom.xml', u'\n'.join(lines), index)
+
+
+def publish(path, settings, cache_path, index, pages, files=None):
+    """Update the page index and write the sitemap and feed of the
+    website. """
+    update_index(index, path, pages, files)
+    write_sitemap(path, settings, index)
+    feed = settings.get('feed', False)
+    if isinstance(feed, dict) or feed:
+        write_feed(path, settings, index)
+    save_index(cache_path, index)
@@ -0,0 +1,218 @@
+"""Tests for the stream mode and style caching of the build command. """
+
+import os
+import shutil
+import tempfile
+import os.path as pth
+from esmero.command import build
+
+
+class Arg(object):  # pylint: disable=R0903
+    """Command line arguments of the build command. """
+    force = False
+
+
+class Conn(object):
+    """Collects the message sent by a build worker. """
+    def __init__(self):
+        self.data = None
+
+    def send(self, data):
+        """Store the data sent by the worker. """
+        self.data = data
+
+    def close(self):
+        """Nothing to release. """
+        pass
+
+
+class Parser(object):  # pylint: disable=R0903
+    """Stands for the lexor parser kept by the worker. """
+    doc = None
+
+
+def _patch(**kwargs):
+    """Replace attributes of the build module and return the
+    originals. """
+    old = dict()
+    for name, val in kwargs.iteritems():
+        old[name] = getattr(build, name)
+        setattr(build, name, val)
+    return old
+
+
+def _restore(old):
+    """Restore the attributes replaced by `_patch`. """
+    for name, val in old.iteritems():
+        setattr(build, name, val)
+
+
+def _fake_build(fname, *_):
+    """Stands for `build_file`. """
+    return {'title': fname}
+
+
+def _run_worker(files, theme_redo, budget):
+    """Run a worker on `files` and return what it sends. """
+    conn = Conn()
+    build._build_worker(conn, files, {}, theme_redo, Arg(), {}, {}, '.',
+                        budget)
+    return conn.data
+
+
+def test_budget():
+    """The budget is read from the build settings. """
+    cfg = {'build': {'max_pages': '3', 'max_memory': '1.5'}}
+    assert build.get_budget(cfg) == (3, 1.5)
+
+
+def test_budget_errors():
+    """Invalid budgets are reported. """
+    for pages, memory in [('x', '0'), ('0', 'x'), ('-1', '0'), ('0', '-1')]:
+        cfg = {'build': {'max_pages': pages, 'max_memory': memory}}
+        try:
+            build.get_budget(cfg)
+        except SystemExit:
+            continue
+        raise AssertionError('%s, %s was accepted' % (pages, memory))
+
+
+def test_worker_page_budget():
+    """A worker stops once it builds `max_pages` pages. """
+    old = _patch(build_file=_fake_build,
+                 get_style=lambda *_: Parser())
+    try:
+        files = ['p%d.lex' % num for num in xrange(5)]
+        checked, built, _, pages, _ = _run_worker(files, True, (2, 0))
+    finally:
+        _restore(old)
+    assert (checked, built) == (2, 2)
+    assert sorted(pages) == files[:2]
+
+
+def test_worker_skips_up_to_date():
+    """Up to date files are checked but do not count as built. """
+    path = tempfile.mkdtemp()
+    old = _patch(build_file=_fake_build,
+                 get_style=lambda *_: Parser())
+    try:
+        files = list()
+        for num in xrange(3):
+            lex_file = pth.join(path, 'p%d.lex' % num)
+            open(lex_file, 'w').close()
+            os.utime(lex_file, (1000, 1000))
+            files.append(lex_file)
+        for lex_file in files[:2]:
+            open(lex_file[:-4] + '.html', 'w').close()
+        checked, built, _, pages, _ = _run_worker(files, False, (1, 0))
+    finally:
+        _restore(old)
+        shutil.rmtree(path)
+    assert (checked, built) == (3, 1)
+    assert pages.keys() == [files[2]]
+
+
+def test_worker_memory_budget():
+    """A worker stops once its memory grows by `max_memory`. """
+    memory = iter([100.0, 105.0, 120.0, 130.0])
+    old = _patch(build_file=_fake_build,
+                 get_style=lambda *_: Parser(),
+                 current_memory=lambda: next(memory))
+    try:
+        files = ['p%d.lex' % num for num in xrange(5)]
+        checked, built, growth, _, _ = _run_worker(files, True, (0, 10))
+    finally:
+        _restore(old)
+    assert (checked, built) == (2, 2)
+    assert growth == 20.0
+
+
+def _fake_worker(conn, files, *_):
+    """Stands for `_build_worker`: checks two files at a time. """
+    stats = dict((key, 0) for key in build.STYLE_STATS)
+    pages = dict((fname, None) for fname in files[:2])
+    conn.send((len(files[:2]), len(pages), 0.0, pages, stats))
+    conn.close()
+
+
+def test_stream_advances():
+    """Every file is handed to exactly one worker. """
+    old = _patch(_build_worker=_fake_worker)
+    try:
+        files = ['p%d.lex' % num for num in xrange(5)]
+        pages = build.build_site_stream(Arg(), {}, {}, files, '.', {}, True,
+                                        (2, 0))
+    finally:
+        _restore(old)
+    assert sorted(pages) == files
+
+
+class NodeConverter(object):  # pylint: disable=R0903
+    """Stands for a lexor node converter class. """
+    directive = 'p'
+    directive_alias = []
+
+
+class Container(object):  # pylint: disable=R0903
+    """Stands for the lexor container of a node converter. """
+    def __init__(self, nc_class):
+        self.nc_class = nc_class
+
+
+class Converter(object):
+    """Records the style resolutions done by a lexor converter. """
+    resolved = 0
+
+    def __init__(self, *_):
+        self.defaults = dict()
+        self.style_module = None
+        self._directives = None
+        self._node_converters = None
+        self._reload = True
+
+    def _set_node_converters(self, *_):
+        """Resolve the style. """
+        Converter.resolved += 1
+        self.style_module = 'style'
+        self.defaults = {'opt': '1'}
+        self._directives = dict()
+        self._node_converters = dict()
+        self.register(NodeConverter)
+        self._reload = False
+
+    def register(self, nc_class):
+        """Add a node converter class. """
+        self._node_converters[nc_class.__name__] = Container(nc_class)
+        self._directives[nc_class.directive] = nc_class
+
+
+class Core(object):  # pylint: disable=R0903
+    """Stands for the `lexor.core` module. """
+    Converter = Converter
+
+
+def test_converter_cache():
+    """Converters are new objects but the style is resolved once for
+    each search path. """
+    lexorinputs = os.environ.get('LEXORINPUTS')
+    old = _patch(core=Core(), CONVERTER_CACHE=dict())
+    try:
+        os.environ['LEXORINPUTS'] = 'a'
+        first = build.get_converter('lexor', 'html', 'default')
+        second = build.get_converter('lexor', 'html', 'default')
+        assert Converter.resolved == 1
+        assert first is not second
+        assert second.style_module == 'style'
+        assert second.defaults == {'opt': '1'}
+        assert second.defaults is not first.defaults
+        assert second._node_converters.keys() == ['NodeConverter']
+        assert second._reload is False
+        os.environ['LEXORINPUTS'] = 'b'
+        build.get_converter('lexor', 'html', 'default')
+        assert Converter.resolved == 2
+    finally:
+        _restore(old)
+        if lexorinputs is None:
+            del os.environ['LEXORINPUTS']
+        else:
+            os.environ['LEXORINPUTS'] = lexorinputs
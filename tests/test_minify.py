@@ -0,0 +1,76 @@
+"""Tests for the html minification stage. """
+
+import os
+import shutil
+import tempfile
+import os.path as pth
+from esmero import minify
+
+
+def test_preserved_blocks():
+    """The contents of pre, script and textarea are not modified. """
+    text = (
+        '<pre>  a\n  b</pre>\n<script>\n var x  = 1;\n</script>\n'
+        '<textarea>  x\n</textarea>'
+    )
+    result = minify.minify(text, minify.OPTIONS)
+    assert '<pre>  a\n  b</pre>' in result
+    assert '<script>\n var x  = 1;\n</script>' in result
+    assert '<textarea>  x\n</textarea>' in result
+
+
+def test_comments():
+    """Comments are removed except conditional comments. """
+    text = '<p>a<!-- note --></p><!--[if IE]><p>ie</p><![endif]-->'
+    result = minify.minify(text, ['comments'])
+    assert 'note' not in result
+    assert '<!--[if IE]><p>ie</p><![endif]-->' in result
+
+
+def test_attributes():
+    """Whitespace inside attribute values is kept. """
+    text = '<p title="x\n  y" class=\'a  b\'>\n  hi  <b>there</b>\n</p>'
+    result = minify.minify(text, ['whitespace'])
+    assert result == (
+        '<p title="x\n  y" class=\'a  b\'> hi <b>there</b> </p>'
+    )
+
+
+def test_optional_tags():
+    """Optional end tags are dropped. """
+    text = '<ul><li>a</li><li>b</li></ul><table><tr><td>c</td></tr></table>'
+    result = minify.minify(text, ['optional-tags'])
+    assert result == '<ul><li>a<li>b</ul><table><tr><td>c</table>'
+
+
+def test_options():
+    """The minify setting selects the transformations. """
+    assert minify.get_options({}) == []
+    assert minify.get_options({'minify': True}) == minify.OPTIONS
+    assert minify.get_options({'minify': {'comments': True}}) == [
+        'comments'
+    ]
+
+
+def test_cache():
+    """A file with the same content is served from the cache. """
+    path = tempfile.mkdtemp()
+    try:
+        fname = pth.join(path, 'a.html')
+        cache = pth.join(path, 'cache')
+        with open(fname, 'w') as tmpf:
+            tmpf.write('<p>\n  a </p>')
+        minify.minify_file(fname, minify.OPTIONS, cache)
+        entry = pth.join(cache, os.listdir(cache)[0])
+        with open(entry) as tmpf:
+            digest = tmpf.readline()
+        with open(entry, 'w') as tmpf:
+            tmpf.write(digest + 'cached')
+        with open(fname, 'w') as tmpf:
+            tmpf.write('<p>\n  a </p>')
+        minify.minify_file(fname, minify.OPTIONS, cache)
+        with open(fname) as tmpf:
+            assert tmpf.read() == 'cached'
+        assert len(os.listdir(cache)) == 1
+    finally:
+        shutil.rmtree(path)
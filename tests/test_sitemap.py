@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""Tests for the sitemap and feed generation. """
+
+import os
+import shutil
+import tempfile
+import os.path as pth
+from esmero import sitemap
+
+
+def _make_site(names):
+    """Create a website with an html file for each lexor file. """
+    path = tempfile.mkdtemp()
+    for name in names:
+        with open(pth.join(path, name[:-4] + '.html'), 'w') as tmpf:
+            tmpf.write('<p>%s</p>' % name)
+    return path
+
+
+def test_non_ascii():
+    """Non-ascii titles and file names are written as utf-8. """
+    path = _make_site(['caf\xc3\xa9.lex'])
+    try:
+        cache = pth.join(path, '.esmero')
+        fname = pth.join(path, 'caf\xc3\xa9.lex')
+        settings = {u'site-url': u'http://example.org', u'feed': True}
+        index = sitemap.load_index(cache)
+        sitemap.publish(path, settings, cache, index,
+                        {fname: {'title': 'Caf\xc3\xa9'}}, [fname])
+        index = sitemap.load_index(cache)
+        assert index['pages'][u'caf\xe9.html']['title'] == u'Caf\xe9'
+        assert sitemap.unindexed(index, path, [fname]) == set()
+        with open(pth.join(path, 'sitemap.xml')) as tmpf:
+            assert '<loc>http://example.org/caf%C3%A9.html</loc>' in tmpf.read()
+        with open(pth.join(path, 'atom.xml')) as tmpf:
+            assert '<title>Caf\xc3\xa9</title>' in tmpf.read()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_unbuilt_pages():
+    """Pages without metadata are indexed from their html file. """
+    path = _make_site(['a.lex'])
+    try:
+        cache = pth.join(path, '.esmero')
+        fname = pth.join(path, 'a.lex')
+        index = sitemap.load_index(cache)
+        sitemap.publish(path, {'site-url': 'http://example.org'}, cache,
+                        index, {fname: None}, [fname])
+        entry = sitemap.load_index(cache)['pages']['a.html']
+        assert 'title' not in entry
+        assert 'hash' in entry and 'lastmod' in entry
+    finally:
+        shutil.rmtree(path)
+
+
+def test_shards():
+    """Large sitemaps are split and stale shards are removed. """
+    names = ['p%d.lex' % num for num in xrange(3)]
+    path = _make_site(names)
+    try:
+        cache = pth.join(path, '.esmero')
+        files = [pth.join(path, name) for name in names]
+        settings = {'site-url': 'http://example.org', 'sitemap-size': 2}
+        index = sitemap.load_index(cache)
+        sitemap.publish(path, settings, cache, index,
+                        dict((fname, {}) for fname in files), files)
+        assert pth.exists(pth.join(path, 'sitemap-2.xml'))
+        sitemap.publish(path, settings, cache, index, {}, files[:2])
+        assert not pth.exists(pth.join(path, 'sitemap-1.xml'))
+        assert sorted(index['pages']) == ['p0.html', 'p1.html']
+    finally:
+        shutil.rmtree(path)
+
+
+def test_feed_dates():
+    """Page dates are used for both the order and the updated tag. """
+    path = _make_site(['a.lex', 'b.lex'])
+    try:
+        cache = pth.join(path, '.esmero')
+        files = [pth.join(path, 'a.lex'), pth.join(path, 'b.lex')]
+        settings = {'site-url': 'http://example.org', 'feed': {}}
+        pages = {
+            files[0]: {'date': '2001-01-01'},
+            files[1]: {'date': 'March 3, 2002'},
+        }
+        sitemap.publish(path, settings, cache, sitemap.load_index(cache),
+                        pages, files)
+        with open(pth.join(path, 'atom.xml')) as tmpf:
+            text = tmpf.read()
+        assert '<updated>2002-03-03T00:00:00Z</updated>' in text
+        assert text.index('b.html') < text.index('a.html')
+    finally:
+        shutil.rmtree(path)
+
+
+def test_quoted_urls():
+    """Spaces in file names are percent-encoded. """
+    path = _make_site(['my page.lex'])
+    try:
+        cache = pth.join(path, '.esmero')
+        fname = pth.join(path, 'my page.lex')
+        sitemap.publish(path, {'site-url': 'http://example.org'}, cache,
+                        sitemap.load_index(cache), {fname: {}}, [fname])
+        with open(pth.join(path, 'sitemap.xml')) as tmpf:
+            assert '<loc>http://example.org/my%20page.html</loc>' in \
+                tmpf.read()
+    finally:
+        shutil.rmtree(path)
+
+
+def test_unchanged_lastmod():
+    """Rebuilding a page with the same content keeps its lastmod. """
+    path = _make_site(['a.lex'])
+    try:
+        cache = pth.join(path, '.esmero')
+        fname = pth.join(path, 'a.lex')
+        html_file = pth.join(path, 'a.html')
+        settings = {'site-url': 'http://example.org'}
+        os.utime(html_file, (1000, 1000))
+        index = sitemap.load_index(cache)
+        sitemap.publish(path, settings, cache, index, {fname: {}}, [fname])
+        lastmod = index['pages']['a.html']['lastmod']
+        os.utime(html_file, (2000, 2000))
+        sitemap.publish(path, settings, cache, index, {fname: {}}, [fname])
+        assert index['pages']['a.html']['lastmod'] == lastmod
+        with open(html_file, 'w') as tmpf:
+            tmpf.write('<p>changed</p>')
+        sitemap.publish(path, settings, cache, index, {fname: {}}, [fname])
+        assert index['pages']['a.html']['lastmod'] != lastmod
+    finally:
+        shutil.rmtree(path)